@@ -1,11 +1,258 @@
 import numpy as np
-import sys
+import os
+import argparse
+import functools
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import onnx
-from onnx import helper, numpy_helper, TensorProto
-from NNet.utils.readNNet import readNNet
+from onnx import helper, TensorProto
+from NNet.utils.readNNet import readNNet, readNNetHeader
 from NNet.utils.normalizeNNet import normalizeNNet
 
-def nnet2onnx(nnetFile, onnxFile="", outputVar="y_out", inputVar="X", normalizeNetwork=False):
+# Weight size in bytes above which initializers are written to an external data file by default
+_EXTERNAL_DATA_THRESHOLD = 100_000_000
+
+# Set NNET_VALIDATE=1 to check the layer shapes of every network before converting it
+_VALIDATE = os.environ.get("NNET_VALIDATE") == "1"
+
+# Model metadata key recording a digest of the source file and the conversion options, used to decide whether an existing .onnx file is up to date
+_OPTIONS_KEY = "nnet2onnx_options"
+
+# Packed buffer size in bytes above which arrays are copied into it by a thread pool
+_PARALLEL_PACK_THRESHOLD = 1 << 24
+
+# Byte alignment of each array in the packed buffer, so float32 data stays aligned after int8 data
+_PACK_ALIGNMENT = 16
+
+_FLOAT32 = np.dtype("<f4")
+_INT8 = np.dtype("i1")
+_TENSOR_TYPES = {_FLOAT32: TensorProto.FLOAT, _INT8: TensorProto.INT8}
+
+def _load_nnet_mmap(nnetFile):
+    """
+    Read the weights and biases of a .nnet file through a binary .nnet.npz sidecar.
+
+    The first read parses the ASCII file and writes the sidecar next to it as float32 arrays; later reads load the
+    binary arrays directly. The sidecar records the modification time and size of the .nnet file it was built from,
+    and is regenerated whenever either differs or it cannot be read.
+    NumPy cannot memory-map members of an .npz archive, so arrays are read eagerly, but without any text parsing.
+    """
+    sidecar = nnetFile + ".npz"
+    stat = os.stat(nnetFile)
+    source = [stat.st_mtime_ns, stat.st_size]
+    if os.path.exists(sidecar):
+        try:
+            with np.load(sidecar) as data:
+                fresh = "source" in data.files and data["source"].tolist() == source
+                arrays = [data[f"arr_{i}"] for i in range(len(data.files) - 1)] if fresh else []
+        except Exception as e:
+            print(f"Warning: could not read binary sidecar {sidecar}, rebuilding it: {e}")
+            arrays = []
+        if arrays and len(arrays) % 2 == 0:
+            numLayers = len(arrays) // 2
+            return arrays[:numLayers], arrays[numLayers:]
+
+    weights, biases = readNNet(nnetFile)
+    weights = [w.astype(np.float32) for w in weights]
+    biases = [b.astype(np.float32) for b in biases]
+
+    # Write to a temporary file and move it into place, so readers never see a partially written sidecar
+    tmpFile = None
+    try:
+        fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(sidecar) or ".", prefix=os.path.basename(sidecar), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, *weights, *biases, source=np.array(source, dtype=np.int64))
+        # mkstemp creates the file readable by its owner only; give the sidecar the same permissions as the .nnet file
+        os.chmod(tmpFile, stat.st_mode & 0o666)
+        os.replace(tmpFile, sidecar)
+    except OSError as e:
+        print(f"Warning: could not write binary sidecar {sidecar}: {e}")
+        if tmpFile is not None and os.path.exists(tmpFile):
+            os.remove(tmpFile)
+    return weights, biases
+
+@functools.lru_cache(maxsize=32)
+def _load_nnet_cached(nnetFile, mtime_ns, normalizeNetwork):
+    """
+    Parse a .nnet file once per (path, modification time, normalization) key.
+
+    The mtime_ns argument is only part of the cache key so that edits to the file invalidate the cached entry.
+    Returned arrays are marked read-only because they are shared between callers.
+    """
+    if normalizeNetwork:
+        weights, biases = normalizeNNet(nnetFile)
+    else:
+        weights, biases = _load_nnet_mmap(nnetFile)
+
+    for arr in weights + biases:
+        arr.setflags(write=False)
+    return tuple(weights), tuple(biases)
+
+def _load_nnet(nnetFile, normalizeNetwork=False):
+    """
+    Read (and optionally normalize) a .nnet file, reusing the parsed weights and biases of earlier calls.
+
+    Returns:
+        weights, biases: Tuples of read-only weight matrices and bias vectors
+    """
+    return _load_nnet_cached(nnetFile, os.stat(nnetFile).st_mtime_ns, normalizeNetwork)
+
+def _init(arr, name):
+    """
+    Build an initializer directly from the raw bytes of a little-endian float32 or int8 array.
+
+    ONNX raw_data is little-endian, which makes this a single copy of contiguous arrays on typical hosts.
+    """
+    return TensorProto(name=name, data_type=_TENSOR_TYPES[arr.dtype], dims=list(arr.shape), raw_data=arr.tobytes())
+
+def _pack(arrays, dtypes):
+    """
+    Copy arrays, converted to the given dtypes, into one contiguous byte buffer.
+
+    Each array starts at an offset aligned to _PACK_ALIGNMENT bytes.
+
+    Returns:
+        pool: Flat uint8 buffer holding every array
+        offsets: Byte offsets of each array in pool
+    """
+    nbytes = [arr.size * dtype.itemsize for arr, dtype in zip(arrays, dtypes)]
+    offsets = []
+    size = 0
+    for n in nbytes:
+        offsets.append(size)
+        size += -(-n // _PACK_ALIGNMENT) * _PACK_ALIGNMENT
+    pool = np.zeros(size, dtype=np.uint8)
+
+    def fill(arr, dtype, start, n):
+        pool[start:start + n].view(dtype).reshape(arr.shape)[...] = arr
+
+    # Each array goes to a disjoint slice, and NumPy releases the GIL while copying, so large copies can overlap
+    if size > _PARALLEL_PACK_THRESHOLD and len(arrays) > 1:
+        with ThreadPoolExecutor(max_workers=min(8, len(arrays))) as executor:
+            list(executor.map(fill, arrays, dtypes, offsets, nbytes))
+    else:
+        for arr, dtype, start, n in zip(arrays, dtypes, offsets, nbytes):
+            fill(arr, dtype, start, n)
+    return pool, offsets
+
+def _initializers(names, arrays, dtypes, location=None):
+    """
+    Build initializers for arrays from slices of a single packed buffer.
+
+    Args:
+        names (list): Initializer names, one per array
+        arrays (list): Arrays to store
+        dtypes (list): Little-endian float32 or int8 dtype to store each array as
+        location (str, optional): If given, the initializers reference this external data file instead of holding raw
+            data. The caller must write the returned pool to that file.
+
+    Returns:
+        initializers, pool: List of TensorProtos and the packed buffer backing them
+    """
+    pool, offsets = _pack(arrays, dtypes)
+    if location is None:
+        return [_init(pool[start:start + arr.size * dtype.itemsize].view(dtype).reshape(arr.shape), name)
+                for name, arr, dtype, start in zip(names, arrays, dtypes, offsets)], pool
+
+    initializers = []
+    for name, arr, dtype, start in zip(names, arrays, dtypes, offsets):
+        tensor = TensorProto(name=name, data_type=_TENSOR_TYPES[dtype], dims=list(arr.shape),
+                             data_location=TensorProto.EXTERNAL)
+        for key, value in (("location", location), ("offset", start), ("length", arr.size * dtype.itemsize)):
+            entry = tensor.external_data.add()
+            entry.key = key
+            entry.value = str(value)
+        initializers.append(tensor)
+    return initializers, pool
+
+def _quantize_int8(weight):
+    """
+    Quantize a weight matrix to int8 with a symmetric scale per output neuron (row).
+
+    Returns:
+        quantized, scale: int8 matrix with the shape of weight, and float32 scale vector such that
+            weight ~= quantized * scale[:, None]
+    """
+    scale = np.abs(weight).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    quantized = np.clip(np.round(weight / scale[:, None]), -127, 127).astype(np.int8)
+    return quantized, scale.astype(np.float32)
+
+@functools.lru_cache(maxsize=32)
+def _build_operations(inputVar, outputVar, reluLayers, quantized=False):
+    """
+    Build the graph nodes for a network topology, reusing them across conversions of networks with the same topology.
+
+    Args:
+        inputVar (str): Name of the graph input
+        outputVar (str): Name of the graph output
+        reluLayers (tuple): For each hidden layer, whether its output goes through a Relu node
+        quantized (bool): If True, each layer's weights W{i} are produced by dequantizing the int8 initializer Wq{i}
+            with the per-output scales Ws{i}
+
+    Returns:
+        Tuple of NodeProtos. make_graph copies them into the graph, so the cached nodes are never modified.
+    """
+    operations = []
+    numLayers = len(reluLayers) + 1
+
+    # Loop through each layer of the network and add operations
+    for i in range(numLayers):
+        # Fully connected layer computing X * W + B. The weights are stored transposed to [in, out] at conversion time
+        # so no transpose is needed at inference. ONNX Runtime fuses the following Relu into this node (FusedGemm).
+        layerInput = inputVar if i == 0 else f"R{i-1}"
+        if quantized:
+            operations.append(helper.make_node("DequantizeLinear", [f"Wq{i}", f"Ws{i}"], [f"W{i}"], axis=1))
+
+        # Use ReLU activation for hidden layers that need it. The last layer writes to outputVar
+        if i == numLayers - 1:
+            layerOutput = outputVar
+        elif reluLayers[i]:
+            layerOutput = f"H{i}"
+        else:
+            layerOutput = f"R{i}"
+        operations.append(helper.make_node("Gemm", [layerInput, f"W{i}", f"B{i}"], [layerOutput], alpha=1.0, beta=1.0))
+        if layerOutput == f"H{i}":
+            operations.append(helper.make_node("Relu", [f"H{i}"], [f"R{i}"]))
+    return tuple(operations)
+
+def _file_digest(path):
+    """
+    Compute the SHA-256 hex digest of a file's contents.
+
+    Args:
+        path (str): Path to the file
+
+    Returns:
+        (str): Hex digest of the file
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _is_up_to_date(onnxFile, options):
+    """
+    Check whether onnxFile was converted from the same source contents with the same options.
+
+    The file must record the same source digest and options in its metadata, and have its external data file
+    present if it uses one.
+    """
+    try:
+        model = onnx.load(onnxFile, load_external_data=False)
+    except Exception:
+        return False
+
+    if {prop.key: prop.value for prop in model.metadata_props}.get(_OPTIONS_KEY) != options:
+        return False
+    if any(init.data_location == TensorProto.EXTERNAL for init in model.graph.initializer):
+        return os.path.exists(onnxFile + ".data")
+    return True
+
+def nnet2onnx(nnetFile, onnxFile="", outputVar="y_out", inputVar="X", normalizeNetwork=False, externalData=None,
+              validate=False, staticBatch=None, foldRelu=False, force=False, quantize=None):
     """
     Convert a .nnet file to ONNX format.
 
@@ -15,12 +262,47 @@ def nnet2onnx(nnetFile, onnxFile="", outputVar="y_out", inputVar="X", normalizeN
         outputVar (str, optional): Name of the output variable in ONNX. Default is "y_out".
         inputVar (str, optional): Name of the input variable in ONNX. Default is "X".
         normalizeNetwork (bool, optional): If True, adapt the network weights and biases so that networks and inputs do not need to be normalized. Default is False.
+        externalData (bool, optional): If True, store the initializers in a separate <onnxFile>.data file next to the model, which avoids the 2 GB protobuf limit. Default is None, which does so only for networks with more than 100 MB of weights.
+        validate (bool, optional): If True, only read the network architecture from the file header and report it, without converting. Default is False.
+        staticBatch (int, optional): Fixed batch size for the graph input and output, for backends that require static shapes. Default is None, which declares a symbolic batch dimension.
+        foldRelu (bool, optional): If True, omit Relu nodes after hidden layers whose output is provably non-negative, i.e. layers with non-negative weights and biases following another ReLU layer. Default is False.
+        force (bool, optional): If True, convert even if onnxFile was already created from the same nnetFile contents with the same options. Default is False.
+        quantize (str, optional): If "int8", store weight matrices as int8 with a scale per output neuron, dequantized in the graph by DequantizeLinear nodes. Biases stay float32. Default is None, which stores float32 weights.
     """
+    if quantize not in (None, "int8"):
+        print(f"Error: Unsupported quantization {quantize}, only int8 is supported.")
+        return
+    if staticBatch is not None and (isinstance(staticBatch, bool) or not isinstance(staticBatch, (int, np.integer)) or staticBatch <= 0):
+        print(f"Error: Static batch size must be a positive integer, got {staticBatch}.")
+        return
+
+    if validate:
+        try:
+            layerSizes = readNNetHeader(nnetFile)
+        except Exception as e:
+            print(f"Error reading NNet file: {e}")
+            return
+        print(f"{nnetFile}: {len(layerSizes) - 1} layers with sizes {layerSizes}")
+        return
+
+    # Default ONNX filename if none specified
+    if not onnxFile:
+        onnxFile = nnetFile[:-5] + ".onnx" if nnetFile.endswith(".nnet") else nnetFile + ".onnx"
+
+    # Skip the conversion if the existing ONNX file is already up to date. The source is identified by a digest of its
+    # contents rather than its path or modification time, so identical conversions produce byte-identical models
     try:
-        if normalizeNetwork:
-            weights, biases = normalizeNNet(nnetFile)
-        else:
-            weights, biases = readNNet(nnetFile)
+        digest = _file_digest(nnetFile)
+    except OSError as e:
+        print(f"Error reading NNet file: {e}")
+        return
+    options = repr((digest, inputVar, outputVar, normalizeNetwork, externalData, staticBatch, foldRelu, quantize))
+    if not force and _is_up_to_date(onnxFile, options):
+        print(f"ONNX model at {onnxFile} is up to date with {nnetFile}, skipping conversion")
+        return
+
+    try:
+        weights, biases = _load_nnet(nnetFile, normalizeNetwork)
     except Exception as e:
         print(f"Error reading NNet file: {e}")
         return
@@ -34,57 +316,93 @@ def nnet2onnx(nnetFile, onnxFile="", outputVar="y_out", inputVar="X", normalizeN
     outputSize = weights[-1].shape[0]
     numLayers = len(weights)
 
-    # Default ONNX filename if none specified
-    if not onnxFile:
-        onnxFile = f"{nnetFile[:-4]}.onnx"
-
-    # Initialize graph inputs and outputs
-    inputs = [helper.make_tensor_value_info(inputVar, TensorProto.FLOAT, [None, inputSize])]
-    outputs = [helper.make_tensor_value_info(outputVar, TensorProto.FLOAT, [None, outputSize])]
-    operations = []
-    initializers = []
-
-    # Loop through each layer of the network and add operations and initializers
-    for i in range(numLayers):
-        # Ensure dimensions match for matrix multiplication
-        if i > 0 and weights[i].shape[1] != weights[i - 1].shape[0]:
+    # Ensure dimensions match between consecutive layers, and between each weight matrix and its bias vector.
+    # readNNet builds every matrix from the declared layer sizes, so this only matters for untrusted producers.
+    if _VALIDATE:
+        inDims = np.fromiter((w.shape[1] for w in weights), dtype=np.int64, count=numLayers)
+        outDims = np.fromiter((w.shape[0] for w in weights), dtype=np.int64, count=numLayers)
+        biasDims = np.fromiter((b.shape[0] for b in biases), dtype=np.int64, count=len(biases))
+        if not np.array_equal(inDims[1:], outDims[:-1]):
+            i = np.flatnonzero(inDims[1:] != outDims[:-1])[0] + 1
             print(f"Error: Shape mismatch between layers {i-1} and {i} in weights.")
             return
+        if len(biasDims) != numLayers:
+            print(f"Error: Found {numLayers} weight matrices but {len(biasDims)} bias vectors.")
+            return
+        if not np.array_equal(biasDims, outDims):
+            i = np.flatnonzero(biasDims != outDims)[0]
+            print(f"Error: Shape mismatch between weights and biases of layer {i}.")
+            return
 
-        # Use outputVar for the last layer
-        outputName = f"H{i}" if i < numLayers - 1 else outputVar
-
-        # Weight matrix multiplication
-        operations.append(helper.make_node("MatMul", [inputVar if i == 0 else f"R{i-1}", f"W{i}"], [f"M{i}"]))
-        initializers.append(numpy_helper.from_array(weights[i].astype(np.float32), name=f"W{i}"))
+    # Initialize graph inputs and outputs
+    batchDim = int(staticBatch) if staticBatch is not None else "batch"
+    inputs = [helper.make_tensor_value_info(inputVar, TensorProto.FLOAT, [batchDim, inputSize])]
+    outputs = [helper.make_tensor_value_info(outputVar, TensorProto.FLOAT, [batchDim, outputSize])]
 
-        # Bias addition
-        operations.append(helper.make_node("Add", [f"M{i}", f"B{i}"], [outputName]))
-        initializers.append(numpy_helper.from_array(biases[i].astype(np.float32), name=f"B{i}"))
+    # Layers that need a ReLU. With foldRelu, it is omitted after hidden layers whose input comes from an earlier ReLU
+    # layer and whose weights and biases are non-negative, since their output is then already non-negative.
+    reluLayers = tuple(not (foldRelu and i > 0 and (weights[i] >= 0).all() and (biases[i] >= 0).all())
+                       for i in range(numLayers - 1))
+    operations = _build_operations(inputVar, outputVar, reluLayers, quantize is not None)
 
-        # Use ReLU activation for all layers except the last layer
-        if i < numLayers - 1:
-            operations.append(helper.make_node("Relu", [f"H{i}"], [f"R{i}"]))
+    # Pack all weights ([in, out]) and biases, in graph order, into one buffer backing every initializer
+    if quantize:
+        quantizedWeights = [_quantize_int8(w) for w in weights]
+        names = [name for i in range(numLayers) for name in (f"Wq{i}", f"Ws{i}", f"B{i}")]
+        arrays = [arr for (q, scale), b in zip(quantizedWeights, biases) for arr in (q.T, scale, b)]
+        dtypes = [_INT8, _FLOAT32, _FLOAT32] * numLayers
+    else:
+        names = [name for i in range(numLayers) for name in (f"W{i}", f"B{i}")]
+        arrays = [arr for w, b in zip(weights, biases) for arr in (w.T, b)]
+        dtypes = [_FLOAT32, _FLOAT32] * numLayers
+    if externalData is None:
+        externalData = sum(arr.size * dtype.itemsize for arr, dtype in zip(arrays, dtypes)) > _EXTERNAL_DATA_THRESHOLD
+    dataLocation = os.path.basename(onnxFile) + ".data" if externalData else None
+    initializers, pool = _initializers(names, arrays, dtypes, dataLocation)
 
     # Create the graph and model in ONNX
     graph_proto = helper.make_graph(operations, "nnet2onnx_Model", inputs, outputs, initializers)
-    model_def = helper.make_model(graph_proto)
+    # Pin the opset and IR version rather than inheriting whatever the installed onnx package defaults to
+    model_def = helper.make_model(graph_proto, producer_name="nnet2onnx", opset_imports=[helper.make_opsetid("", 17)])
+    model_def.ir_version = 8
+    helper.set_model_props(model_def, {_OPTIONS_KEY: options})
 
     # Print statements
     print(f"Converted NNet model at {nnetFile} to an ONNX model at {onnxFile}")
 
     # Save the ONNX model
     try:
-        onnx.save(model_def, onnxFile)
+        if externalData:
+            # The initializers already reference their offsets in the packed buffer, so it is written in one go
+            pool.tofile(os.path.join(os.path.dirname(onnxFile), dataLocation))
+        with open(onnxFile, "wb", buffering=1 << 20) as f:
+            onnx.save_model(model_def, f)
         print(f"ONNX model saved successfully at {onnxFile}")
     except Exception as e:
         print(f"Error saving the ONNX model: {e}")
 
+def _positive_int(value):
+    """
+    Parse a command line argument as a positive integer.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not an integer")
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        nnetFile = sys.argv[1]
-        onnxFile = sys.argv[2] if len(sys.argv) > 2 else ""
-        outputVar = sys.argv[3] if len(sys.argv) > 3 else "y_out"
-        nnet2onnx(nnetFile, onnxFile, outputVar)
-    else:
-        print("Error: Need to specify the .nnet file to convert to ONNX!")
+    parser = argparse.ArgumentParser(description="Convert a .nnet file to ONNX format.")
+    parser.add_argument("nnetFile", help=".nnet file to convert to ONNX")
+    parser.add_argument("onnxFile", nargs="?", default="", help="name for the created .onnx file")
+    parser.add_argument("outputVar", nargs="?", default="y_out", help="name of the output variable in ONNX")
+    parser.add_argument("--validate", action="store_true", help="only read and report the network architecture")
+    parser.add_argument("--static-batch", type=_positive_int, metavar="N", help="use a fixed batch size N instead of a symbolic one")
+    parser.add_argument("--fold-relu", action="store_true", help="omit Relu nodes whose input is provably non-negative")
+    parser.add_argument("--force", action="store_true", help="convert even if the .onnx file is already up to date")
+    parser.add_argument("--quantize", choices=["int8"], help="store weight matrices with the given quantization")
+    args = parser.parse_args()
+    nnet2onnx(args.nnetFile, args.onnxFile, args.outputVar, validate=args.validate, staticBatch=args.static_batch,
+              foldRelu=args.fold_relu, force=args.force, quantize=args.quantize)
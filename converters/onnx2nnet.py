@@ -1,7 +1,7 @@
 import numpy as np
 import sys
 import onnx
-from onnx import numpy_helper
+from onnx import helper, numpy_helper
 from NNet.utils.writeNNet import writeNNet
 
 def onnx2nnet(onnxFile, inputMins=None, inputMaxes=None, means=None, ranges=None, nnetFile="", inputName="", outputName=""):
@@ -42,15 +42,55 @@ def onnx2nnet(onnxFile, inputMins=None, inputMaxes=None, means=None, ranges=None
     weights = []
     biases = []
 
+    # Dequantize weight matrices stored as quantized initializers feeding DequantizeLinear nodes. Nodes that take any
+    # other input, such as quantized activations, are left alone and reported as unsupported below.
+    initializers = {inits.name: inits for inits in graph.initializer}
+    dequantized = {}
+    for node in graph.node:
+        if node.op_type == "DequantizeLinear" and all(name in initializers for name in node.input if name):
+            x = numpy_helper.to_array(initializers[node.input[0]]).astype(np.float32)
+            scale = numpy_helper.to_array(initializers[node.input[1]])
+            zeroPoint = numpy_helper.to_array(initializers[node.input[2]]) if len(node.input) > 2 and node.input[2] else None
+            axis = next((helper.get_attribute_value(attr) for attr in node.attribute if attr.name == "axis"), 1)
+            if scale.ndim == 1:
+                # Per-axis quantization: broadcast the scale and zero point along every other dimension
+                otherAxes = [d for d in range(x.ndim) if d != axis % x.ndim]
+                scale = np.expand_dims(scale, otherAxes)
+                zeroPoint = np.expand_dims(zeroPoint, otherAxes) if zeroPoint is not None else None
+            if zeroPoint is not None:
+                x -= zeroPoint.astype(np.float32)
+            dequantized[node.output[0]] = x * scale
+
     # Loop through nodes in graph
     for node in graph.node:
         if inputName in node.input:
             if node.op_type == "MatMul":
                 assert len(node.input) == 2, "MatMul node must have exactly 2 inputs."
                 
-                # Extract weight matrix
-                weightName = node.input[1] if node.input[0] == inputName else node.input[0]
-                weights += [numpy_helper.to_array(inits) for inits in graph.initializer if inits.name == weightName]
+                # Extract weight matrix. MatMul(X, W) stores W as [in, out], so transpose it to the .nnet [out, in]
+                # order; MatMul(W, x) already stores W as [out, in]
+                inputFirst = node.input[0] == inputName
+                weightName = node.input[1] if inputFirst else node.input[0]
+                weight = [numpy_helper.to_array(inits) for inits in graph.initializer if inits.name == weightName]
+                weights += [w.T for w in weight] if inputFirst else weight
+
+                # Update input name to be the output of this node
+                inputName = node.output[0]
+
+            elif node.op_type == "Gemm":
+                assert len(node.input) == 3, "Gemm node must have exactly 3 inputs."
+                assert node.input[0] == inputName, "Gemm node must take the layer input as its first input."
+                attributes = {attr.name: helper.get_attribute_value(attr) for attr in node.attribute}
+                assert attributes.get("alpha", 1.0) == 1.0 and attributes.get("beta", 1.0) == 1.0 and \
+                    not attributes.get("transA", 0), "Only Gemm nodes with alpha=1, beta=1, and transA=0 are supported."
+
+                # Extract weight matrix in [out, in] order, and the bias vector
+                if node.input[1] in dequantized:
+                    weight = [dequantized[node.input[1]]]
+                else:
+                    weight = [numpy_helper.to_array(inits) for inits in graph.initializer if inits.name == node.input[1]]
+                weights += weight if attributes.get("transB", 0) else [w.T for w in weight]
+                biases += [numpy_helper.to_array(inits) for inits in graph.initializer if inits.name == node.input[2]]
 
                 # Update input name to be the output of this node
                 inputName = node.output[0]
@@ -79,7 +119,7 @@ def onnx2nnet(onnxFile, inputMins=None, inputMaxes=None, means=None, ranges=None
 
     # Check if weights and biases were successfully extracted
     if outputName == inputName and len(weights) == len(biases) > 0:
-        inputSize = weights[0].shape[0]
+        inputSize = weights[0].shape[1]
 
         # Set default values for input bounds and normalization constants if not provided
         inputMins = inputMins if inputMins is not None else [np.finfo(np.float32).min] * inputSize
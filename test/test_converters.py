@@ -1,15 +1,17 @@
 import unittest
 import os
+import shutil
+import tempfile
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import onnxruntime
-from NNet.converters.nnet2onnx import nnet2onnx
+import onnx
+import onnx.numpy_helper
+from onnx import helper, TensorProto
+from NNet.converters.nnet2onnx import nnet2onnx, _initializers
 from NNet.converters.onnx2nnet import onnx2nnet
-from NNet.converters.pb2nnet import pb2nnet
-from NNet.converters.nnet2pb import nnet2pb
 from NNet.python.nnet import NNet
 from NNet.utils.writeNNet import writeNNet
-import tensorflow as tf
-from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
 
 
 class TestConverters(unittest.TestCase):
@@ -20,6 +22,8 @@ class TestConverters(unittest.TestCase):
 
     def test_onnx(self):
         """Test conversion between NNet and ONNX format."""
+        import onnxruntime
+
         onnxFile = self.nnetFile[:-4] + ".onnx"
         nnetFile2 = self.nnetFile[:-4] + "v2.nnet"
 
@@ -59,8 +63,281 @@ class TestConverters(unittest.TestCase):
         np.testing.assert_allclose(nnetEval, onnxEval.flatten(), rtol=1e-5)
         np.testing.assert_allclose(nnetEval, nnetEval2, rtol=1e-5)
 
+    def test_onnx_external_data(self):
+        """Test conversion from NNet to ONNX with initializers stored in an external data file."""
+        import onnxruntime
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            onnxFile = os.path.join(tmpDir, "TestNetwork_external.onnx")
+
+            nnet2onnx(self.nnetFile, onnxFile=onnxFile, normalizeNetwork=True, externalData=True)
+            self.assertTrue(os.path.exists(onnxFile), f"{onnxFile} not found!")
+            self.assertTrue(os.path.exists(onnxFile + ".data"), f"{onnxFile}.data not found!")
+
+            sess = onnxruntime.InferenceSession(onnxFile, providers=['CPUExecutionProvider'])
+            testInput = np.array([1.0, 1.0, 1.0, 100.0, 1.0], dtype=np.float32).reshape(1, -1)
+            onnxEval = sess.run(None, {sess.get_inputs()[0].name: testInput})[0]
+
+        nnetEval = NNet(self.nnetFile).evaluate_network(testInput[0])
+        np.testing.assert_allclose(nnetEval, onnxEval.flatten(), rtol=1e-5)
+
+    def test_onnx_batch_dimension(self):
+        """Test the symbolic and static batch dimensions of the ONNX input and output."""
+        with tempfile.TemporaryDirectory() as tmpDir:
+            onnxFile = os.path.join(tmpDir, "TestNetwork.onnx")
+            staticFile = os.path.join(tmpDir, "TestNetwork_static.onnx")
+            invalidFile = os.path.join(tmpDir, "TestNetwork_invalid.onnx")
+
+            nnet2onnx(self.nnetFile, onnxFile=onnxFile)
+            graph = onnx.load(onnxFile).graph
+            for value in (graph.input[0], graph.output[0]):
+                dims = value.type.tensor_type.shape.dim
+                self.assertEqual(dims[0].dim_param, "batch")
+                self.assertFalse(dims[0].HasField("dim_value"))
+                self.assertEqual(dims[1].dim_value, 5)
+
+            nnet2onnx(self.nnetFile, onnxFile=staticFile, staticBatch=4)
+            graph = onnx.load(staticFile).graph
+            for value in (graph.input[0], graph.output[0]):
+                self.assertEqual([d.dim_value for d in value.type.tensor_type.shape.dim], [4, 5])
+
+            for staticBatch in (0, -1):
+                nnet2onnx(self.nnetFile, onnxFile=invalidFile, staticBatch=staticBatch)
+                self.assertFalse(os.path.exists(invalidFile), f"{invalidFile} created for staticBatch={staticBatch}")
+
+    def test_onnx_fold_relu(self):
+        """Test that ReLU nodes are omitted for layers with provably non-negative outputs."""
+        import onnxruntime
+
+        nnet = NNet(self.nnetFile)
+        weights = [np.abs(w) for w in nnet.weights]
+        biases = [np.abs(b) for b in nnet.biases]
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            nnetFile = os.path.join(tmpDir, "NonNegative.nnet")
+            onnxFile = os.path.join(tmpDir, "NonNegative.onnx")
+            writeNNet(weights, biases, nnet.mins, nnet.maxes, nnet.means, nnet.ranges, nnetFile)
+            nnet2onnx(nnetFile, onnxFile=onnxFile, normalizeNetwork=True, foldRelu=True)
+
+            # Only the first hidden layer needs a ReLU, since its input may be negative
+            ops = [node.op_type for node in onnx.load(onnxFile).graph.node]
+            self.assertEqual(ops.count("Relu"), 1)
+
+            sess = onnxruntime.InferenceSession(onnxFile, providers=['CPUExecutionProvider'])
+            testInput = np.array([1.0, 1.0, 1.0, 100.0, 1.0], dtype=np.float32).reshape(1, -1)
+            onnxEval = sess.run(None, {sess.get_inputs()[0].name: testInput})[0]
+            nnetEval = NNet(nnetFile).evaluate_network(testInput[0])
+
+        np.testing.assert_allclose(nnetEval, onnxEval.flatten(), rtol=1e-5)
+
+    def test_onnx_quantize(self):
+        """Test conversion from NNet to ONNX with int8 weights, and back to NNet."""
+        import onnxruntime
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            onnxFile = os.path.join(tmpDir, "TestNetwork.onnx")
+            quantizedFile = os.path.join(tmpDir, "TestNetwork_int8.onnx")
+            nnetFile2 = os.path.join(tmpDir, "TestNetwork_int8.nnet")
+
+            nnet2onnx(self.nnetFile, onnxFile=onnxFile, normalizeNetwork=True)
+            nnet2onnx(self.nnetFile, onnxFile=quantizedFile, normalizeNetwork=True, quantize="int8")
+            self.assertLess(os.path.getsize(quantizedFile), os.path.getsize(onnxFile) / 2)
+
+            sess = onnxruntime.InferenceSession(quantizedFile, providers=['CPUExecutionProvider'])
+            testInput = np.array([1.0, 1.0, 1.0, 100.0, 1.0], dtype=np.float32).reshape(1, -1)
+            onnxEval = sess.run(None, {sess.get_inputs()[0].name: testInput})[0]
+
+            onnx2nnet(quantizedFile, nnetFile=nnetFile2)
+            nnetEval2 = NNet(nnetFile2).evaluate_network(testInput[0])
+
+        nnetEval = NNet(self.nnetFile).evaluate_network(testInput[0])
+        # int8 weights only approximate the original network, but the dequantized round trip matches the ONNX model
+        np.testing.assert_allclose(nnetEval, onnxEval.flatten(), rtol=5e-2)
+        np.testing.assert_allclose(onnxEval.flatten(), nnetEval2, rtol=1e-4)
+
+    def test_onnx2nnet_matmul(self):
+        """Test converting an ONNX graph built from MatMul(W, x), Add, and Relu nodes to NNet."""
+        onnxFile = "nnet/TestNetwork2.onnx"
+        self.assertTrue(os.path.exists(onnxFile), f"{onnxFile} not found!")
+        model = onnx.load(onnxFile)
+        initializers = {init.name: onnx.numpy_helper.to_array(init) for init in model.graph.initializer}
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            nnetFile = os.path.join(tmpDir, "TestNetwork2.nnet")
+            onnx2nnet(onnxFile, nnetFile=nnetFile)
+            self.assertTrue(os.path.exists(nnetFile), f"{nnetFile} not found!")
+            nnet = NNet(nnetFile)
+
+        self.assertEqual(nnet.weights[0].shape, initializers["W0"].shape)
+        testInput = np.array([1.0, 1.0, 1.0, 100.0, 1.0], dtype=np.float32)
+        expected = testInput
+        for i in range(nnet.numLayers):
+            expected = initializers[f"W{i}"] @ expected + initializers[f"B{i}"]
+            if i < nnet.numLayers - 1:
+                expected = np.maximum(expected, 0)
+        np.testing.assert_allclose(nnet.evaluate_network(testInput), expected, rtol=1e-4)
+
+    def test_onnx2nnet_quantized_activations(self):
+        """Test that a graph dequantizing activations is reported as unsupported instead of raising."""
+        weight = onnx.numpy_helper.from_array(np.ones((2, 3), dtype=np.float32), name="W")
+        bias = onnx.numpy_helper.from_array(np.zeros(3, dtype=np.float32), name="B")
+        scale = onnx.numpy_helper.from_array(np.array(0.1, dtype=np.float32), name="S")
+        zeroPoint = onnx.numpy_helper.from_array(np.array(0, dtype=np.int8), name="Z")
+
+        for withZeroPoint in (False, True):
+            qdqInputs = ["Q", "S", "Z"] if withZeroPoint else ["Q", "S"]
+            nodes = [helper.make_node("QuantizeLinear", ["X", "S", "Z"], ["Q"]),
+                     helper.make_node("DequantizeLinear", qdqInputs, ["D"]),
+                     helper.make_node("Gemm", ["D", "W", "B"], ["y_out"])]
+            graph = helper.make_graph(nodes, "qdq", [helper.make_tensor_value_info("X", TensorProto.FLOAT, [None, 2])],
+                                      [helper.make_tensor_value_info("y_out", TensorProto.FLOAT, [None, 3])],
+                                      [weight, bias, scale, zeroPoint])
+
+            with tempfile.TemporaryDirectory() as tmpDir:
+                onnxFile = os.path.join(tmpDir, "qdq.onnx")
+                nnetFile = os.path.join(tmpDir, "qdq.nnet")
+                onnx.save(helper.make_model(graph), onnxFile)
+
+                onnx2nnet(onnxFile, nnetFile=nnetFile)
+                self.assertFalse(os.path.exists(nnetFile), f"{nnetFile} created for an unsupported graph")
+
+    def test_onnx_up_to_date(self):
+        """Test that an up-to-date ONNX file is not converted again unless forced or the options change."""
+        with tempfile.TemporaryDirectory() as tmpDir:
+            onnxFile = os.path.join(tmpDir, "TestNetwork.onnx")
+
+            # Backdate the ONNX file to the .nnet file's modification time so a rewrite is detectable
+            nnet2onnx(self.nnetFile, onnxFile=onnxFile)
+            mtime = os.stat(self.nnetFile).st_mtime_ns
+            os.utime(onnxFile, ns=(mtime, mtime))
+
+            nnet2onnx(self.nnetFile, onnxFile=onnxFile)
+            self.assertEqual(os.stat(onnxFile).st_mtime_ns, mtime)
+
+            nnet2onnx(self.nnetFile, onnxFile=onnxFile, force=True)
+            self.assertNotEqual(os.stat(onnxFile).st_mtime_ns, mtime)
+
+            os.utime(onnxFile, ns=(mtime, mtime))
+            nnet2onnx(self.nnetFile, onnxFile=onnxFile, normalizeNetwork=True)
+            self.assertNotEqual(os.stat(onnxFile).st_mtime_ns, mtime)
+
+            # A different source file with the same modification time must still be converted
+            nnet = NNet(self.nnetFile)
+            otherFile = os.path.join(tmpDir, "Other.nnet")
+            otherWeights = [np.abs(w) for w in nnet.weights]
+            writeNNet(otherWeights, nnet.biases, nnet.mins, nnet.maxes, nnet.means, nnet.ranges, otherFile)
+            os.utime(otherFile, ns=(mtime, mtime))
+            nnet2onnx(otherFile, onnxFile=onnxFile, normalizeNetwork=True)
+
+            initializers = {init.name: onnx.numpy_helper.to_array(init) for init in onnx.load(onnxFile).graph.initializer}
+            np.testing.assert_allclose(initializers["W1"], otherWeights[1].T, rtol=1e-5)
+
+    def test_onnx_reproducible(self):
+        """Test that converting the same network to different paths gives identical files without local paths."""
+        with tempfile.TemporaryDirectory() as tmpDir:
+            firstFile = os.path.join(tmpDir, "First.onnx")
+            otherDir = os.path.join(tmpDir, "other")
+            os.mkdir(otherDir)
+            secondFile = os.path.join(otherDir, "Second.onnx")
+            nnet2onnx(self.nnetFile, onnxFile=firstFile)
+            nnet2onnx(os.path.abspath(self.nnetFile), onnxFile=secondFile)
+
+            with open(firstFile, "rb") as f, open(secondFile, "rb") as g:
+                self.assertEqual(f.read(), g.read())
+            metadata = "".join(prop.value for prop in onnx.load(firstFile).metadata_props)
+            self.assertNotIn(os.path.dirname(os.path.abspath(self.nnetFile)), metadata)
+
+    def test_onnx_corrupt_sidecar(self):
+        """Test that an unreadable binary sidecar is rebuilt instead of failing the conversion."""
+        with tempfile.TemporaryDirectory() as tmpDir:
+            nnetFile = os.path.join(tmpDir, "TestNetwork.nnet")
+            onnxFile = os.path.join(tmpDir, "TestNetwork.onnx")
+            shutil.copy(self.nnetFile, nnetFile)
+
+            # A truncated sidecar
+            with open(nnetFile + ".npz", "wb") as f:
+                f.write(b"PK")
+
+            nnet2onnx(nnetFile, onnxFile=onnxFile)
+            self.assertTrue(os.path.exists(onnxFile), f"{onnxFile} not found!")
+            with np.load(nnetFile + ".npz") as data:
+                self.assertIn("source", data.files)
+                self.assertEqual(len(data.files), 2 * len(NNet(nnetFile).weights) + 1)
+
+    def test_onnx_validate_shapes(self):
+        """Test that mismatched layer shapes are reported when NNET_VALIDATE is enabled."""
+        mismatches = [
+            ([np.ones((3, 2)), np.ones((4, 5))], [np.ones(3), np.ones(4)]),
+            ([np.ones((3, 2)), np.ones((4, 3))], [np.ones(3)]),
+            ([np.ones((3, 2)), np.ones((4, 3))], [np.ones(3), np.ones(5)]),
+        ]
+        with tempfile.TemporaryDirectory() as tmpDir:
+            onnxFile = os.path.join(tmpDir, "Mismatch.onnx")
+            for weights, biases in mismatches:
+                with mock.patch("NNet.converters.nnet2onnx._VALIDATE", True), \
+                        mock.patch("NNet.converters.nnet2onnx._load_nnet", return_value=(weights, biases)), \
+                        mock.patch("builtins.print") as printed:
+                    nnet2onnx(self.nnetFile, onnxFile=onnxFile, force=True)
+                self.assertFalse(os.path.exists(onnxFile), f"{onnxFile} created for mismatched shapes")
+                self.assertTrue(any("Shape mismatch" in str(call) or "bias vectors" in str(call)
+                                    for call in printed.call_args_list))
+
+    def test_parallel_pack(self):
+        """Test that packing initializers with the thread pool gives the same bytes as the serial path."""
+        nnet = NNet(self.nnetFile)
+        arrays = [arr for w, b in zip(nnet.weights, nnet.biases) for arr in (w.T, b)]
+        arrays.append(np.arange(-5, 6, dtype=np.int8))
+        names = [f"T{i}" for i in range(len(arrays))]
+        dtypes = [np.dtype("<f4")] * (len(arrays) - 1) + [np.dtype("i1")]
+
+        serial, serialPool = _initializers(names, arrays, dtypes)
+        with mock.patch("NNet.converters.nnet2onnx._PARALLEL_PACK_THRESHOLD", 0), \
+                mock.patch("NNet.converters.nnet2onnx.ThreadPoolExecutor", wraps=ThreadPoolExecutor) as executor:
+            parallel, parallelPool = _initializers(names, arrays, dtypes)
+        executor.assert_called_once()
+
+        self.assertEqual(serialPool.tobytes(), parallelPool.tobytes())
+        self.assertEqual([t.SerializeToString() for t in serial], [t.SerializeToString() for t in parallel])
+
+    @unittest.skipIf(os.name != "posix", "file permission bits are only meaningful on POSIX")
+    def test_onnx_sidecar_permissions(self):
+        """Test that the binary sidecar gets the same permissions as its .nnet file."""
+        with tempfile.TemporaryDirectory() as tmpDir:
+            nnetFile = os.path.join(tmpDir, "TestNetwork.nnet")
+            shutil.copy(self.nnetFile, nnetFile)
+            os.chmod(nnetFile, 0o644)
+
+            nnet2onnx(nnetFile, onnxFile=os.path.join(tmpDir, "TestNetwork.onnx"))
+            self.assertEqual(os.stat(nnetFile + ".npz").st_mode & 0o777, 0o644)
+
+    def test_onnx_replaced_source(self):
+        """Test that replacing a .nnet file with an older one is not served from the stale binary sidecar."""
+        with tempfile.TemporaryDirectory() as tmpDir:
+            nnetFile = os.path.join(tmpDir, "TestNetwork.nnet")
+            olderFile = os.path.join(tmpDir, "Older.nnet")
+            onnxFile = os.path.join(tmpDir, "TestNetwork.onnx")
+            shutil.copy(self.nnetFile, nnetFile)
+
+            nnet = NNet(self.nnetFile)
+            olderWeights = [np.abs(w) for w in nnet.weights]
+            writeNNet(olderWeights, nnet.biases, nnet.mins, nnet.maxes, nnet.means, nnet.ranges, olderFile)
+            mtime = os.stat(nnetFile).st_mtime_ns - 10**9
+            os.utime(olderFile, ns=(mtime, mtime))
+
+            nnet2onnx(nnetFile, onnxFile=onnxFile)
+            shutil.copy2(olderFile, nnetFile)
+            nnet2onnx(nnetFile, onnxFile=onnxFile)
+
+            initializers = {init.name: onnx.numpy_helper.to_array(init) for init in onnx.load(onnxFile).graph.initializer}
+            np.testing.assert_allclose(initializers["W0"], olderWeights[0].T, rtol=1e-5)
+
     def test_pb(self):
         """Test conversion between NNet and TensorFlow Protocol Buffer (PB) format."""
+        # TensorFlow is slow and memory-hungry to import, so only load it for the test that needs it
+        import tensorflow as tf
+        from NNet.converters.pb2nnet import pb2nnet
+        from NNet.converters.nnet2pb import nnet2pb
+
         pbFile = self.nnetFile[:-4] + ".pb"
         nnetFile2 = self.nnetFile[:-4] + "v2.nnet"
 
@@ -2,7 +2,7 @@ import unittest
 import os
 import numpy as np
 from NNet.python.nnet import NNet
-from NNet.utils.readNNet import readNNet
+from NNet.utils.readNNet import readNNet, readNNetHeader
 from NNet.utils.writeNNet import writeNNet
 from NNet.utils.normalizeNNet import normalizeNNet
 
@@ -35,6 +35,15 @@ class TestUtils(unittest.TestCase):
         self.assertTrue(np.allclose(means, nnet.means, rtol=1e-5))
         self.assertTrue(np.allclose(ranges, nnet.ranges, rtol=1e-5))
 
+    def test_read_header(self):
+        """Test reading only the architecture of a NNet file."""
+        weights, biases = readNNet(self.nnetFile1)
+        layerSizes = readNNetHeader(self.nnetFile1)
+
+        self.assertEqual(len(layerSizes), len(weights) + 1)
+        self.assertEqual(layerSizes[0], weights[0].shape[1])
+        self.assertEqual(layerSizes[1:], [len(b) for b in biases])
+
     def test_write(self):
         """Test writing a NNet model to a file and comparing outputs."""
         nnet1 = NNet(self.nnetFile1)
@@ -1,5 +1,46 @@
 import numpy as np
 
+def _readArchitecture(f):
+    '''
+    Skip the header comments of an open .nnet file and read the network architecture lines
+
+    Returns:
+        numLayers: Number of layers in the network
+        layerSizes: Sizes of the input layer followed by each network layer
+    '''
+    # Skip header lines
+    line = f.readline()
+    while line[:2] == "//":
+        line = f.readline()
+
+    # Extract information about network architecture
+    record = line.split(',')
+    numLayers = int(record[0])
+
+    line = f.readline()
+    layerSizes = [int(x) for x in line.strip().split(',') if x]
+
+    # Ensure that the architecture information is correct
+    assert len(layerSizes) == numLayers + 1, "Layer sizes don't match number of layers."
+    return numLayers, layerSizes
+
+def readNNetHeader(nnetFile):
+    '''
+    Read only the architecture of a .nnet file, without parsing its weights and biases
+
+    Inputs:
+        nnetFile: (string) .nnet file to read
+
+    Returns:
+        layerSizes: List of layer sizes, beginning with the input size and ending with the output size
+    '''
+    try:
+        with open(nnetFile, 'r') as f:
+            return _readArchitecture(f)[1]
+    except Exception as e:
+        print(f"Error reading NNet file header: {e}")
+        raise
+
 def readNNet(nnetFile, withNorm=False):
     '''
     Read a .nnet file and return list of weight matrices and bias vectors
@@ -15,21 +56,7 @@ def readNNet(nnetFile, withNorm=False):
     try:
         # Open NNet file
         with open(nnetFile, 'r') as f:
-            # Skip header lines
-            line = f.readline()
-            while line[:2] == "//":
-                line = f.readline()
-
-            # Extract information about network architecture
-            record = line.split(',')
-            numLayers = int(record[0])
-            inputSize = int(record[1])
-
-            line = f.readline()
-            layerSizes = [int(x) for x in line.strip().split(',') if x]
-
-            # Ensure that the architecture information is correct
-            assert len(layerSizes) == numLayers + 1, "Layer sizes don't match number of layers."
+            numLayers, layerSizes = _readArchitecture(f)
 
             # Skip extra obsolete parameter line
             f.readline()